@@ -16,10 +16,11 @@ document.addEventListener('DOMContentLoaded', function() {
         fileInput.addEventListener('change', function(e) {
             const file = e.target.files[0];
             if (file) {
-                // Check file size (16MB max)
-                const maxSize = 16 * 1024 * 1024; // 16MB in bytes
+                // Check file size against the server's limit
+                const form = document.getElementById('addBookForm');
+                const maxSize = (form && parseInt(form.dataset.maxSize, 10)) || 16 * 1024 * 1024;
                 if (file.size > maxSize) {
-                    alert('File size must be less than 16MB');
+                    alert('File size must be less than ' + formatFileSize(maxSize));
                     e.target.value = '';
                     return;
                 }
@@ -73,8 +74,33 @@ document.addEventListener('DOMContentLoaded', function() {
 
             // Show loading state
             const submitBtn = addBookForm.querySelector('button[type="submit"]');
+            const submitLabel = submitBtn.innerHTML;
             submitBtn.innerHTML = '<i class="fas fa-spinner fa-spin me-1"></i>Adding Book...';
             submitBtn.disabled = true;
+
+            // Send the PDF in resumable chunks, then submit the form with the upload id
+            if (addBookForm.dataset.uploadUrl && window.crypto && crypto.subtle) {
+                e.preventDefault();
+                const progress = document.getElementById('uploadProgress');
+                const bar = progress.querySelector('.progress-bar');
+                progress.classList.remove('d-none');
+                submitBtn.innerHTML = '<i class="fas fa-spinner fa-spin me-1"></i>' + submitBtn.dataset.uploadingLabel;
+                resumableUpload(file, addBookForm.dataset.uploadUrl, fraction => {
+                    const percent = Math.round(fraction * 100) + '%';
+                    bar.style.width = percent;
+                    bar.textContent = percent;
+                }).then(result => {
+                    document.getElementById('uploadId').value = result.id;
+                    document.getElementById('uploadChecksum').value = result.checksum;
+                    document.getElementById('file').disabled = true;
+                    addBookForm.submit();
+                }).catch(() => {
+                    progress.classList.add('d-none');
+                    submitBtn.innerHTML = submitLabel;
+                    submitBtn.disabled = false;
+                    alert(submitBtn.dataset.failedLabel);
+                });
+            }
         });
     }
 
@@ -93,13 +119,22 @@ document.addEventListener('DOMContentLoaded', function() {
             // Show loading spinner
             showLoadingSpinner();
             
+            // Send the advanced filters along with the question
+            const payload = { query: query };
+            ['author', 'category', 'language', 'yearFrom', 'yearTo'].forEach(name => {
+                const field = document.getElementById(name);
+                if (field && field.value.trim()) {
+                    payload[name] = field.value.trim();
+                }
+            });
+            
             // Make AJAX request to AI search API
             fetch('/ai_search_api', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ query: query })
+                body: JSON.stringify(payload)
             })
             .then(response => response.json())
             .then(data => {
@@ -118,6 +153,15 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    // Typeahead suggestions for every search box
+    document.querySelectorAll('input[name="q"]').forEach(initializeSuggestions);
+
+    // In-browser reader with saved progress and bookmarks
+    const reader = document.getElementById('pdfReader');
+    if (reader && window.pdfjsLib) {
+        initializeReader(reader);
+    }
+
     // Search functionality enhancement
     const searchInput = document.querySelector('input[name="q"]');
     if (searchInput) {
@@ -243,6 +287,356 @@ function debounce(func, wait) {
     };
 }
 
+// Typeahead: debounced /suggest requests, cancelling any request still in flight
+function initializeSuggestions(input) {
+    input.setAttribute('autocomplete', 'off');
+    const container = input.parentNode;
+    if (getComputedStyle(container).position === 'static') {
+        container.style.position = 'relative';
+    }
+    const menu = document.createElement('div');
+    menu.className = 'list-group suggest-menu shadow';
+    menu.style.display = 'none';
+    container.appendChild(menu);
+
+    let controller = null;
+    let activeIndex = -1;
+
+    function hideMenu() {
+        menu.style.display = 'none';
+        menu.innerHTML = '';
+        activeIndex = -1;
+    }
+
+    function renderSuggestions(suggestions) {
+        menu.innerHTML = '';
+        activeIndex = -1;
+        if (!suggestions.length) {
+            hideMenu();
+            return;
+        }
+        suggestions.forEach(item => {
+            const link = document.createElement('a');
+            link.className = 'list-group-item list-group-item-action';
+            link.href = item.url;
+            const title = document.createElement('div');
+            title.className = 'fw-semibold';
+            title.textContent = item.title;
+            const author = document.createElement('small');
+            author.className = 'text-muted';
+            author.textContent = item.author;
+            link.appendChild(title);
+            link.appendChild(author);
+            menu.appendChild(link);
+        });
+        menu.style.display = 'block';
+    }
+
+    const fetchSuggestions = debounce(function(query) {
+        if (controller) {
+            controller.abort();
+        }
+        if (!query) {
+            hideMenu();
+            return;
+        }
+        controller = new AbortController();
+        fetch('/suggest?q=' + encodeURIComponent(query), { signal: controller.signal })
+            .then(response => response.json())
+            .then(data => {
+                // Ignore answers for text the user has since changed
+                if (data.query === input.value.trim()) {
+                    renderSuggestions(data.suggestions || []);
+                }
+            })
+            .catch(error => {
+                if (error.name !== 'AbortError') {
+                    hideMenu();
+                }
+            });
+    }, 150);
+
+    input.addEventListener('input', () => fetchSuggestions(input.value.trim()));
+    input.addEventListener('blur', () => setTimeout(hideMenu, 150));
+    input.addEventListener('keydown', function(e) {
+        const items = menu.querySelectorAll('.list-group-item');
+        if (!items.length) return;
+        if (e.key === 'ArrowDown' || e.key === 'ArrowUp') {
+            e.preventDefault();
+            if (activeIndex >= 0) items[activeIndex].classList.remove('active');
+            activeIndex = (activeIndex + (e.key === 'ArrowDown' ? 1 : -1) + items.length) % items.length;
+            items[activeIndex].classList.add('active');
+        } else if (e.key === 'Enter' && activeIndex >= 0) {
+            e.preventDefault();
+            window.location.href = items[activeIndex].href;
+        } else if (e.key === 'Escape') {
+            hideMenu();
+        }
+    });
+}
+
+// Resumable uploads: chunks go up in parallel and each is retried with backoff.
+// The upload id is remembered per file so a reload continues where it stopped.
+const UPLOAD_PARALLEL_CHUNKS = 3;
+const UPLOAD_MAX_ATTEMPTS = 5;
+const UPLOAD_RETRY_DELAY = 1000;
+
+function parseChunkRanges(header) {
+    const chunks = new Set();
+    (header || '').split(',').filter(Boolean).forEach(range => {
+        const [start, end] = range.split('-').map(Number);
+        for (let chunk = start; chunk <= (isNaN(end) ? start : end); chunk++) chunks.add(chunk);
+    });
+    return chunks;
+}
+
+function toBase64(bytes) {
+    return btoa(String.fromCharCode.apply(null, bytes));
+}
+
+function toHex(bytes) {
+    return Array.from(bytes, byte => byte.toString(16).padStart(2, '0')).join('');
+}
+
+async function resumableUpload(file, createUrl, onProgress) {
+    const storageKey = 'upload:' + [file.name, file.size, file.lastModified].join(':');
+    let upload = JSON.parse(localStorage.getItem(storageKey) || 'null');
+    let received = new Set();
+    if (upload) {
+        const head = await fetch(upload.location, { method: 'HEAD', cache: 'no-store' });
+        if (head.ok) {
+            received = parseChunkRanges(head.headers.get('Upload-Received'));
+        } else {
+            upload = null;
+        }
+    }
+    if (!upload) {
+        const response = await fetch(createUrl, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ size: file.size, filename: file.name })
+        });
+        if (!response.ok) throw new Error(response.status);
+        upload = await response.json();
+        localStorage.setItem(storageKey, JSON.stringify(upload));
+    }
+
+    const chunkCount = Math.ceil(file.size / upload.chunk_size);
+    const digests = new Array(chunkCount);
+    let next = 0;
+    let done = received.size;
+    onProgress(done / chunkCount);
+
+    async function sendChunk(index) {
+        const start = index * upload.chunk_size;
+        const data = await file.slice(start, Math.min(file.size, start + upload.chunk_size)).arrayBuffer();
+        digests[index] = new Uint8Array(await crypto.subtle.digest('SHA-256', data));
+        if (received.has(index)) return;
+        for (let attempt = 1; ; attempt++) {
+            let status = 0;
+            try {
+                const response = await fetch(upload.location, {
+                    method: 'PATCH',
+                    headers: {
+                        'Content-Type': 'application/offset+octet-stream',
+                        'Upload-Offset': String(start),
+                        'Upload-Checksum': 'sha256 ' + toBase64(digests[index])
+                    },
+                    body: data
+                });
+                if (response.ok) break;
+                status = response.status;
+            } catch (error) {
+                // Network error: retry
+            }
+            if (status === 404 || status === 403) {
+                localStorage.removeItem(storageKey);
+                throw new Error(status);
+            }
+            if (attempt >= UPLOAD_MAX_ATTEMPTS) throw new Error('chunk ' + index + ' failed');
+            await new Promise(resolve => setTimeout(resolve, UPLOAD_RETRY_DELAY * 2 ** (attempt - 1)));
+        }
+        done++;
+        onProgress(done / chunkCount);
+    }
+
+    async function worker() {
+        while (next < chunkCount) {
+            await sendChunk(next++);
+        }
+    }
+
+    await Promise.all(Array.from({ length: UPLOAD_PARALLEL_CHUNKS }, worker));
+    const joined = new Uint8Array(digests.length * 32);
+    digests.forEach((digest, index) => joined.set(digest, index * 32));
+    // The id stays remembered: if the server rejects chunks on submit, choosing the file
+    // again resends only those; once the upload is stored, HEAD returns 404 and it is replaced
+    return { id: upload.id, checksum: toHex(new Uint8Array(await crypto.subtle.digest('SHA-256', joined))) };
+}
+
+// Reader: pages render lazily; progress pings are coalesced and sent at most every
+// PROGRESS_SEND_INTERVAL, plus once with sendBeacon when the page is hidden
+const PROGRESS_SEND_INTERVAL = 10000;
+
+function initializeReader(reader) {
+    const bookId = reader.dataset.bookId;
+    const progressUrl = '/api/progress/' + bookId;
+    const bookmarksUrl = '/api/bookmarks/' + bookId;
+    const pageLabel = document.getElementById('readerPage');
+    let currentPage = parseInt(reader.dataset.resumePage, 10) || 1;
+    let pageCount = 0;
+    let pendingProgress = null;
+    let sendTimer = null;
+
+    function sendProgress(useBeacon) {
+        clearTimeout(sendTimer);
+        sendTimer = null;
+        if (!pendingProgress) return;
+        const payload = pendingProgress;
+        pendingProgress = null;
+        const body = JSON.stringify(payload);
+        if (useBeacon && navigator.sendBeacon) {
+            navigator.sendBeacon(progressUrl, new Blob([body], { type: 'application/json' }));
+            return;
+        }
+        fetch(progressUrl, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: body, keepalive: true })
+            .then(response => {
+                if (!response.ok) throw new Error(response.status);
+            })
+            .catch(() => {
+                // Keep the newest position for the next attempt
+                if (!pendingProgress) pendingProgress = payload;
+            });
+    }
+
+    function recordPage(page) {
+        if (page === currentPage) return;
+        currentPage = page;
+        pageLabel.textContent = page;
+        pendingProgress = { page: page, position: pageCount ? page / pageCount : 0, updated_at: Date.now() };
+        if (!sendTimer) {
+            sendTimer = setTimeout(() => sendProgress(false), PROGRESS_SEND_INTERVAL);
+        }
+    }
+
+    document.addEventListener('visibilitychange', () => {
+        if (document.visibilityState === 'hidden') sendProgress(true);
+    });
+    window.addEventListener('pagehide', () => sendProgress(true));
+
+    pdfjsLib.getDocument(reader.dataset.pdfUrl).promise.then(pdf => {
+        pageCount = pdf.numPages;
+        document.getElementById('readerPages').textContent = pageCount;
+        return pdf.getPage(1).then(first => {
+            const ratio = first.getViewport({ scale: 1 }).height / first.getViewport({ scale: 1 }).width;
+            reader.innerHTML = '';
+            const pages = [];
+            for (let number = 1; number <= pageCount; number++) {
+                const holder = document.createElement('div');
+                holder.className = 'reader-page mb-3';
+                holder.dataset.page = number;
+                holder.style.aspectRatio = (1 / ratio).toString();
+                reader.appendChild(holder);
+                pages.push(holder);
+            }
+
+            const renderObserver = new IntersectionObserver(entries => {
+                entries.forEach(entry => {
+                    if (!entry.isIntersecting || entry.target.dataset.rendered) return;
+                    entry.target.dataset.rendered = '1';
+                    renderObserver.unobserve(entry.target);
+                    pdf.getPage(parseInt(entry.target.dataset.page, 10)).then(page => {
+                        const base = page.getViewport({ scale: 1 });
+                        const viewport = page.getViewport({ scale: entry.target.clientWidth / base.width * (window.devicePixelRatio || 1) });
+                        const canvas = document.createElement('canvas');
+                        canvas.width = viewport.width;
+                        canvas.height = viewport.height;
+                        entry.target.appendChild(canvas);
+                        page.render({ canvasContext: canvas.getContext('2d'), viewport: viewport });
+                    });
+                });
+            }, { root: reader.parentElement, rootMargin: '200% 0px' });
+
+            const pageObserver = new IntersectionObserver(entries => {
+                entries.forEach(entry => {
+                    if (entry.isIntersecting) recordPage(parseInt(entry.target.dataset.page, 10));
+                });
+            }, { root: reader.parentElement, threshold: 0.5 });
+
+            pages.forEach(holder => {
+                renderObserver.observe(holder);
+                pageObserver.observe(holder);
+            });
+            const resume = pages[Math.min(currentPage, pageCount) - 1];
+            if (resume) resume.scrollIntoView();
+        });
+    }).catch(error => {
+        reader.innerHTML = '';
+        const message = document.createElement('div');
+        message.className = 'alert alert-danger';
+        message.textContent = error.message;
+        reader.appendChild(message);
+    });
+
+    // Bookmarks are written immediately; ids are generated here so edits from
+    // several devices refer to the same bookmark
+    const list = document.getElementById('bookmarkList');
+    const emptyMessage = document.getElementById('noBookmarks');
+    const noteInput = document.getElementById('bookmarkNote');
+
+    function renderBookmarks(bookmarks) {
+        list.innerHTML = '';
+        emptyMessage.style.display = bookmarks.length ? 'none' : 'block';
+        bookmarks.forEach(bookmark => {
+            const item = document.createElement('div');
+            item.className = 'list-group-item d-flex justify-content-between align-items-center';
+            const link = document.createElement('a');
+            link.href = '#';
+            link.textContent = window.readerLabels.page + ' ' + bookmark.page + (bookmark.note ? ' - ' + bookmark.note : '');
+            link.addEventListener('click', e => {
+                e.preventDefault();
+                const target = reader.querySelector('[data-page="' + bookmark.page + '"]');
+                if (target) target.scrollIntoView();
+            });
+            const remove = document.createElement('button');
+            remove.className = 'btn btn-sm btn-outline-danger';
+            remove.innerHTML = '<i class="fas fa-times"></i>';
+            remove.addEventListener('click', () => {
+                fetch(bookmarksUrl + '/' + encodeURIComponent(bookmark.id), {
+                    method: 'DELETE',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ updated_at: Date.now() })
+                }).then(loadBookmarks);
+            });
+            item.appendChild(link);
+            item.appendChild(remove);
+            list.appendChild(item);
+        });
+    }
+
+    function loadBookmarks() {
+        fetch(bookmarksUrl)
+            .then(response => response.json())
+            .then(data => renderBookmarks(data.bookmarks || []));
+    }
+
+    document.getElementById('addBookmark').addEventListener('click', () => {
+        const id = window.crypto && crypto.randomUUID ? crypto.randomUUID() : Date.now().toString(36) + Math.random().toString(36).slice(2);
+        fetch(bookmarksUrl, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ id: id, page: currentPage, note: noteInput.value.trim(), updated_at: Date.now() })
+        })
+            .then(response => response.json())
+            .then(data => {
+                noteInput.value = '';
+                renderBookmarks(data.bookmarks || []);
+            });
+    });
+
+    loadBookmarks();
+}
+
 // Enhanced search with debouncing
 const debouncedSearch = debounce(function(query) {
     if (query.length > 2) {
@@ -0,0 +1,117 @@
+import os
+import shutil
+import sys
+import types
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """Import app.py against a copy of the shipped library.db, the way gunicorn does.
+
+    Nothing calls init_database() explicitly: importing the module has to be enough.
+    """
+    workdir = tmp_path_factory.mktemp('library')
+    shutil.copy(os.path.join(REPO_ROOT, 'library.db'), workdir / 'library.db')
+    (workdir / 'uploads').mkdir()
+    previous = os.getcwd()
+    os.chdir(workdir)
+    os.environ.setdefault('OPENAI_API_KEY', 'test-key')
+    sys.path.insert(0, REPO_ROOT)
+    try:
+        import app
+    except BaseException:
+        os.chdir(previous)
+        raise
+    app.app.config['TESTING'] = True
+    try:
+        yield app
+    finally:
+        # Buffered writes would otherwise be flushed at exit into the repository's library.db
+        app.analytics_buffer.flush()
+        app.progress_buffer.flush()
+        os.chdir(previous)
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def admin_client(app_module):
+    client = app_module.app.test_client()
+    response = client.post('/login', data={
+        'first_name': 'Test',
+        'last_name': 'Admin',
+        'email': app_module.ALLOWED_ADD_BOOK_EMAIL,
+    })
+    assert response.status_code == 302
+    return client
+
+
+class FakeCompletions:
+    def __init__(self, reply='Here are some books.'):
+        self.reply = reply
+        self.calls = []
+        self.error = None
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.error is not None:
+            raise self.error
+        message = types.SimpleNamespace(content=self.reply)
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=message)],
+            usage=types.SimpleNamespace(total_tokens=42),
+        )
+
+
+@pytest.fixture
+def fake_openai(app_module, monkeypatch):
+    """Replace the OpenAI client; set .error on the returned object to make calls fail.
+
+    Rate-limit buckets and leases are cleared so each test starts with a full budget.
+    """
+    runtime = app_module.get_runtime_connection()
+    runtime.execute('DELETE FROM rate_buckets')
+    runtime.execute('DELETE FROM ai_leases')
+    runtime.execute('DELETE FROM circuit_breakers')
+    runtime.execute('DELETE FROM circuit_breaker_transitions')
+    completions = FakeCompletions()
+    client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=completions))
+    client.with_options = lambda **kwargs: client
+    monkeypatch.setattr(app_module, 'openai_client', client)
+    return completions
+
+
+@pytest.fixture
+def empty_library(app_module, tmp_path, monkeypatch):
+    """Switch to a fresh, migrated library.db and uploads/ for tests that need exact contents."""
+    (tmp_path / 'uploads' / '.tmp').mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+    app_module.init_database()
+    yield tmp_path
+    # Let background work queued by the test finish against this library
+    app_module.BACKGROUND_EXECUTOR.submit(lambda: None).result()
+    app_module.PDF_EXECUTOR.submit(lambda: None).result()
+    app_module.analytics_buffer.flush()
+    app_module.progress_buffer.flush()
+
+
+@pytest.fixture
+def add_book(app_module):
+    """Insert a book row directly, the way add_book() does, and return its id."""
+    def add(title, author='Unknown', filename='book.pdf', **fields):
+        fields = dict(fields, title=title, author=author, filename=filename, **app_module.book_sort_keys(title, author))
+        conn = app_module.get_db_connection()
+        book_id = conn.execute(
+            f'INSERT INTO books ({", ".join(fields)}) VALUES ({", ".join("?" * len(fields))})', list(fields.values())
+        ).lastrowid
+        conn.commit()
+        conn.close()
+        return book_id
+    return add
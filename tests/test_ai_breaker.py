@@ -0,0 +1,85 @@
+import types
+
+import openai
+import pytest
+
+
+@pytest.fixture
+def breaker(app_module, monkeypatch):
+    breaker = app_module.CircuitBreaker('openai', failure_threshold=2, reset_seconds=0, probe_seconds=60)
+    monkeypatch.setattr(app_module, 'openai_breaker', breaker)
+    return breaker
+
+
+def complete(app_module):
+    with app_module.app.test_request_context():
+        return app_module.create_chat_completion([{'role': 'user', 'content': 'hi'}], max_tokens=10)
+
+
+def open_breaker(app_module, fake_openai):
+    fake_openai.error = RuntimeError('unexpected')
+    for _ in range(2):
+        with pytest.raises(app_module.AIUnavailableError):
+            complete(app_module)
+
+
+def test_unexpected_errors_open_the_breaker(app_module, breaker, fake_openai):
+    open_breaker(app_module, fake_openai)
+    assert breaker.snapshot()['state'] == 'open'
+
+
+@pytest.mark.parametrize('error', [RuntimeError('boom'), KeyError('choices'), TimeoutError()])
+def test_failed_probe_does_not_wedge_half_open(app_module, breaker, fake_openai, error):
+    open_breaker(app_module, fake_openai)
+    fake_openai.error = error
+    with pytest.raises(app_module.AIUnavailableError):
+        complete(app_module)
+    assert breaker.snapshot()['transitions'][-1]['reason'].startswith('probe failed')
+
+    fake_openai.error = None
+    assert complete(app_module) == fake_openai.reply
+    assert breaker.snapshot()['state'] == 'closed'
+
+
+def test_state_is_shared_between_workers(app_module, breaker, fake_openai):
+    other_worker = app_module.CircuitBreaker('openai', failure_threshold=2, reset_seconds=60, probe_seconds=60)
+    open_breaker(app_module, fake_openai)
+    assert other_worker.snapshot()['state'] == 'open'
+    assert other_worker.allow_request() is False
+
+
+def test_only_one_probe_at_a_time(app_module, breaker, fake_openai):
+    open_breaker(app_module, fake_openai)
+    assert breaker.allow_request() is True
+    other_worker = app_module.CircuitBreaker('openai', failure_threshold=2, reset_seconds=0, probe_seconds=60)
+    assert other_worker.allow_request() is False
+
+
+def test_ai_metrics_reports_shared_breaker(app_module, admin_client, breaker, fake_openai):
+    open_breaker(app_module, fake_openai)
+    report = admin_client.get('/admin/ai_metrics').get_json()['breaker']
+    assert report['state'] == 'open'
+    assert report['transitions'][-1]['to'] == 'open'
+
+
+def api_status_error(cls, status):
+    response = types.SimpleNamespace(status_code=status, headers={}, request=None)
+    return cls('error', response=response, body=None)
+
+
+def test_client_errors_do_not_open_the_breaker(app_module, breaker, fake_openai):
+    fake_openai.error = api_status_error(openai.BadRequestError, 400)
+    for _ in range(5):
+        with pytest.raises(app_module.AIUnavailableError):
+            complete(app_module)
+    assert len(fake_openai.calls) == 5  # not retried either
+    assert breaker.snapshot()['state'] == 'closed'
+
+
+def test_server_errors_open_the_breaker(app_module, breaker, fake_openai, monkeypatch):
+    monkeypatch.setattr(app_module, 'AI_RETRY_BASE_DELAY', 0)
+    fake_openai.error = api_status_error(openai.InternalServerError, 503)
+    for _ in range(2):
+        with pytest.raises(app_module.AIUnavailableError):
+            complete(app_module)
+    assert breaker.snapshot()['state'] == 'open'
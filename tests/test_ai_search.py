@@ -0,0 +1,76 @@
+import math
+import time
+
+
+def test_ai_search_page_renders_on_shipped_database(admin_client):
+    response = admin_client.get('/ai_search')
+    assert response.status_code == 200
+
+
+def test_ai_search_post_uses_ai_reply(admin_client, fake_openai):
+    response = admin_client.post('/ai_search', data={'query': 'history of Andalusia'})
+    assert response.status_code == 200
+    assert 'Here are some books.' in response.get_data(as_text=True)
+    assert len(fake_openai.calls) == 1
+
+
+def test_ai_search_api_filters_by_category(admin_client, fake_openai):
+    response = admin_client.post('/ai_search_api', json={'query': 'poetry', 'category': 'Literature'})
+    assert response.status_code == 200
+    assert response.get_json()['response'] == 'Here are some books.'
+
+
+def test_empty_query_is_rejected_without_charging(app_module, admin_client, fake_openai):
+    runtime = app_module.get_runtime_connection()
+    for _ in range(int(app_module.AI_USER_REQUEST_BURST) + 2):
+        response = admin_client.post('/ai_search_api', json={'query': '  '})
+        assert response.status_code == 400
+    assert admin_client.post('/ai_search_api', json=['not', 'an', 'object']).status_code == 400
+    assert runtime.execute('SELECT COUNT(*) FROM rate_buckets').fetchone()[0] == 0
+    assert fake_openai.calls == []
+
+
+def test_concurrency_retry_after_follows_earliest_lease(app_module, fake_openai):
+    runtime = app_module.get_runtime_connection()
+    now = time.time()
+    runtime.executemany(
+        'INSERT INTO ai_leases (lease_id, scope, expires_at) VALUES (?, ?, ?)',
+        [(f'lease-{i}', f'user-{i}', now + 40 + i) for i in range(app_module.AI_GLOBAL_MAX_CONCURRENT)]
+    )
+    lease_id, retry_after = app_module.admit_ai_request('someone-else', 100)
+    assert lease_id is None
+    assert 39 <= retry_after <= 41
+
+
+def test_user_bucket_exhaustion_returns_429_with_retry_after(app_module, admin_client, client, fake_openai):
+    burst = int(app_module.AI_USER_REQUEST_BURST)
+    for _ in range(burst):
+        assert admin_client.post('/ai_search_api', json={'query': 'poetry'}).status_code == 200
+    response = admin_client.post('/ai_search_api', json={'query': 'poetry'})
+    assert response.status_code == 429
+    retry_after = int(response.headers['Retry-After'])
+    assert 1 <= retry_after <= math.ceil(60 / app_module.AI_USER_REQUESTS_PER_MINUTE)
+    assert response.get_json()['retry_after'] == retry_after
+    assert len(fake_openai.calls) == burst
+
+    # The bucket is per user: someone else is still admitted
+    client.post('/login', data={'first_name': 'Other', 'last_name': 'Reader', 'email': 'other@example.com'})
+    assert client.post('/ai_search_api', json={'query': 'poetry'}).status_code == 200
+
+
+def user_tokens(app_module, identity):
+    return app_module.get_runtime_connection().execute(
+        'SELECT tokens FROM rate_buckets WHERE key = ?', (f'tok:user:{identity}',)
+    ).fetchone()[0]
+
+
+def test_unused_token_estimate_is_refunded(app_module, admin_client, fake_openai):
+    identity = app_module.ALLOWED_ADD_BOOK_EMAIL
+    capacity = app_module.AI_USER_TOKENS_PER_MINUTE
+    admin_client.post('/ai_search_api', json={'query': 'poetry'})
+    # Charged the estimate up front, settled to the 42 tokens the completion reported
+    assert capacity - 42 <= user_tokens(app_module, identity) <= capacity - 42 + 1
+
+    fake_openai.error = RuntimeError('unexpected')
+    assert admin_client.post('/ai_search_api', json={'query': 'poetry'}).get_json()['degraded']
+    assert user_tokens(app_module, identity) >= capacity - 42
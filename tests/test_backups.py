@@ -0,0 +1,57 @@
+import io
+import os
+import sqlite3
+import threading
+
+import pytest
+
+
+def add_stored_book(app_module, add_book, number):
+    key = app_module.storage.put(io.BytesIO(f'%PDF-1.4 book {number}\n'.encode()), 'pdf')
+    return add_book(f'Book {number}', filename=key)
+
+
+def test_backup_during_writes_verifies_and_restores(app_module, empty_library, add_book, monkeypatch):
+    monkeypatch.setattr(app_module, 'BACKUP_PAGES_PER_STEP', 1)
+    for number in range(50):
+        add_stored_book(app_module, add_book, number)
+
+    stop = threading.Event()
+    inserted = []
+    def write():
+        while not stop.is_set():
+            inserted.append(add_stored_book(app_module, add_book, 1000 + len(inserted)))
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        manifest = app_module.run_backup(workers=4)
+    finally:
+        stop.set()
+        writer.join()
+    assert inserted
+
+    result = app_module.verify_backup(manifest['name'])
+    assert result['ok'], result['errors']
+    assert 50 <= result['books'] <= 50 + len(inserted)
+    assert result['uploads_checked'] == result['books']
+
+    target = empty_library / 'restored'
+    assert app_module.restore_backup(manifest['name'], str(target)) == result['books']
+    conn = sqlite3.connect(target / 'library.db')
+    rows = conn.execute('SELECT filename FROM books').fetchall()
+    conn.close()
+    assert len(rows) == result['books']
+    for (key,) in rows:
+        with open(os.path.join(target, app_module.UPLOAD_FOLDER, *key.split('/')), 'rb') as handle:
+            assert handle.read().startswith(b'%PDF-1.4 book ')
+
+
+def test_verify_and_restore_refuse_while_a_backup_runs(app_module, empty_library, add_book):
+    add_stored_book(app_module, add_book, 1)
+    name = app_module.run_backup(workers=1)['name']
+    with app_module.backup_lock():
+        with pytest.raises(app_module.BackupInProgressError):
+            app_module.verify_backup(name)
+        with pytest.raises(app_module.BackupInProgressError):
+            app_module.restore_backup(name, str(empty_library / 'restored'))
+    assert app_module.verify_backup(name)['ok']
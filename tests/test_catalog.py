@@ -0,0 +1,10 @@
+def test_index_renders_on_shipped_database(admin_client):
+    response = admin_client.get('/')
+    assert response.status_code == 200
+
+
+def test_index_popular_periods(app_module, admin_client):
+    app_module.refresh_book_rankings()
+    for period in app_module.RANKING_PERIODS:
+        assert admin_client.get(f'/?popular={period}').status_code == 200
+    assert admin_client.get('/?popular=bogus').status_code == 200
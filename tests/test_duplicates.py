@@ -0,0 +1,107 @@
+import io
+
+import pytest
+
+
+def duplicate_pairs(app_module):
+    conn = app_module.get_db_connection()
+    rows = conn.execute('SELECT book_id, duplicate_of, score FROM book_duplicates ORDER BY book_id').fetchall()
+    conn.close()
+    return [(row['book_id'], row['duplicate_of'], row['score']) for row in rows]
+
+
+@pytest.mark.parametrize('first, second', [
+    (('The History of Al-Andalus', 'Ibn Khaldun'), ('History of Al-Andalus, 2nd edition', 'Ibn Khaldun')),
+    (('تاريخ الأندلس', 'ابن خلدون'), ('تاريخ الاندلس - الطبعة الثانية', 'ابن خلدون')),
+])
+def test_near_duplicate_editions_are_flagged(app_module, empty_library, add_book, first, second):
+    older = add_book(*first, filename='aa/aa/first.pdf')
+    unrelated = add_book('Organic Chemistry', 'Paula Bruice', filename='bb/bb/other.pdf')
+    app_module.check_book_duplicates(older)
+    app_module.check_book_duplicates(unrelated)
+    newer = add_book(*second, filename='cc/cc/second.pdf')
+    app_module.check_book_duplicates(newer)
+
+    pairs = duplicate_pairs(app_module)
+    assert [(book_id, duplicate_of) for book_id, duplicate_of, _ in pairs] == [(newer, older)]
+    assert pairs[0][2] >= app_module.DEDUP_THRESHOLD
+
+
+def test_same_file_is_a_duplicate_whatever_the_title(app_module, empty_library, add_book):
+    first = add_book('Muqaddimah', 'Ibn Khaldun', filename='dd/dd/same.pdf')
+    app_module.check_book_duplicates(first)
+    second = add_book('Prolegomena', 'Unknown', filename='dd/dd/same.pdf')
+    app_module.check_book_duplicates(second)
+    assert duplicate_pairs(app_module) == [(second, first, 1.0)]
+
+
+def test_unrelated_books_are_not_flagged(app_module, empty_library, add_book):
+    for i, (title, author) in enumerate([('Organic Chemistry', 'Paula Bruice'), ('War and Peace', 'Leo Tolstoy'),
+                          ('ديوان المتنبي', 'المتنبي'), ('The Cairo Trilogy', 'Naguib Mahfouz')]):
+        app_module.check_book_duplicates(add_book(title, author, filename=f'book-{i}.pdf'))
+    assert duplicate_pairs(app_module) == []
+
+
+def put_blob(app_module, content, extension='pdf'):
+    return app_module.storage.put(io.BytesIO(content), extension)
+
+
+def test_merge_moves_reader_state_and_deletes_unshared_blobs(app_module, empty_library, add_book):
+    shared_cover = put_blob(app_module, b'cover image', 'png')
+    keep_id = add_book('History of Al-Andalus', 'Ibn Khaldun', filename=put_blob(app_module, b'kept pdf'))
+    drop_pdf = put_blob(app_module, b'dropped pdf')
+    drop_id = add_book('History of Al-Andalus 2nd ed', 'Ibn Khaldun', filename=drop_pdf, image_filename=shared_cover,
+                       description='From the duplicate', publication_year=1377)
+    add_book('Another book with the same cover', 'Someone', image_filename=shared_cover)
+
+    conn = app_module.get_db_connection()
+    conn.executemany(
+        'INSERT INTO reading_progress (user_email, book_id, page, position, updated_at) VALUES (?, ?, ?, ?, ?)',
+        [('both@x', keep_id, 10, 0.1, 1), ('both@x', drop_id, 50, 0.5, 2), ('dropped@x', drop_id, 7, 0.07, 1)]
+    )
+    conn.execute(
+        "INSERT INTO bookmarks (id, user_email, book_id, page, note, updated_at) VALUES ('bm-merge-1', 'dropped@x', ?, 3, 'n', 1)",
+        (drop_id,)
+    )
+    conn.executemany(
+        'INSERT INTO book_stats_daily (book_id, day, views, downloads) VALUES (?, ?, ?, ?)',
+        [(keep_id, '2026-01-01', 2, 1), (drop_id, '2026-01-01', 3, 1), (drop_id, '2026-01-02', 4, 0)]
+    )
+    conn.executemany(
+        'INSERT INTO book_popularity (book_id, views, downloads, total, log_score) VALUES (?, ?, ?, ?, ?)',
+        [(keep_id, 2, 1, 5.0, 1.0), (drop_id, 7, 1, 10.0, 2.0)]
+    )
+    conn.execute('INSERT INTO book_duplicates (book_id, duplicate_of, score, metadata_score) VALUES (?, ?, 0.9, 0.9)',
+                 (drop_id, keep_id))
+    conn.commit()
+    conn.close()
+
+    assert app_module.merge_books(keep_id, drop_id) is True
+
+    conn = app_module.get_db_connection()
+    kept = conn.execute('SELECT * FROM books WHERE id = ?', (keep_id,)).fetchone()
+    assert conn.execute('SELECT 1 FROM books WHERE id = ?', (drop_id,)).fetchone() is None
+    assert (kept['description'], kept['publication_year'], kept['image_filename']) == ('From the duplicate', 1377, shared_cover)
+    progress = dict(conn.execute('SELECT user_email, page FROM reading_progress WHERE book_id = ?', (keep_id,)).fetchall())
+    assert progress == {'both@x': 10, 'dropped@x': 7}
+    assert conn.execute('SELECT book_id FROM bookmarks WHERE id = ?', ('bm-merge-1',)).fetchone()[0] == keep_id
+    stats = dict(conn.execute('SELECT day, views FROM book_stats_daily WHERE book_id = ?', (keep_id,)).fetchall())
+    assert stats == {'2026-01-01': 5, '2026-01-02': 4}
+    popularity = conn.execute('SELECT views, downloads, total FROM book_popularity WHERE book_id = ?', (keep_id,)).fetchone()
+    assert tuple(popularity) == (9, 2, 15.0)
+    assert conn.execute('SELECT COUNT(*) FROM reading_progress WHERE book_id = ?', (drop_id,)).fetchone()[0] == 0
+    assert conn.execute('SELECT COUNT(*) FROM book_duplicates').fetchone()[0] == 0
+    conn.close()
+
+    assert not app_module.storage.exists(drop_pdf)
+    assert app_module.storage.exists(shared_cover)
+    assert app_module.storage.exists(kept['filename'])
+
+
+def test_merge_keeps_a_pdf_the_kept_book_shares(app_module, empty_library, add_book):
+    pdf = put_blob(app_module, b'identical pdf')
+    keep_id = add_book('Muqaddimah', 'Ibn Khaldun', filename=pdf)
+    drop_id = add_book('Muqaddimah (scan)', 'Ibn Khaldun', filename=pdf)
+    assert app_module.merge_books(keep_id, drop_id) is True
+    assert app_module.storage.exists(pdf)
+    assert app_module.merge_books(keep_id, drop_id) is False
@@ -0,0 +1,61 @@
+import io
+
+import pytest
+
+
+def book_files(app_module):
+    conn = app_module.get_db_connection()
+    files = [row['filename'] for row in conn.execute('SELECT filename FROM books ORDER BY id')]
+    conn.close()
+    return files
+
+
+def test_optimized_pdf_replaces_the_shared_original(app_module, empty_library, add_book, monkeypatch):
+    original = app_module.storage.put(io.BytesIO(b'%PDF-1.4 original, not yet optimized\n'), 'pdf')
+    first = add_book('Palace Walk', filename=original)
+    add_book('Palace Walk (copy)', filename=original)
+
+    def fake_optimize(key):
+        slim = app_module.storage.put(io.BytesIO(b'%PDF-1.4 slim\n'), 'pdf')
+        return {
+            'original_key': key, 'optimized_key': slim, 'status': 'optimized', 'original_size': 38,
+            'optimized_size': 14, 'first_page_bytes_before': 38, 'first_page_bytes_after': 14,
+            'images_recompressed': 0, 'seconds': 0.0, 'error': None,
+        }
+    monkeypatch.setattr(app_module, 'PIKEPDF_AVAILABLE', True)
+    monkeypatch.setattr(app_module, 'optimize_pdf_blob', fake_optimize)
+
+    slim = app_module.optimize_book_pdf(first)['optimized_key']
+    assert book_files(app_module) == [slim, slim]
+    assert app_module.storage.exists(slim)
+    assert not app_module.storage.exists(original)
+
+    # Uploading the original again is repointed without optimizing twice
+    again = app_module.storage.put(io.BytesIO(b'%PDF-1.4 original, not yet optimized\n'), 'pdf')
+    third = add_book('Palace Walk (again)', filename=again)
+    monkeypatch.setattr(app_module, 'optimize_pdf_blob', lambda key: pytest.fail('optimized twice'))
+    app_module.optimize_book_pdf(third)
+    assert book_files(app_module) == [slim, slim, slim]
+    assert not app_module.storage.exists(again)
+
+
+def test_pikepdf_linearizes_and_shrinks_a_pdf(app_module, empty_library, add_book):
+    pikepdf = pytest.importorskip('pikepdf')
+    pdf = pikepdf.new()
+    for number in range(5):
+        pdf.add_blank_page()
+        content = b'BT /F1 12 Tf 72 720 Td (page %d) Tj ET\n' % number * 200
+        pdf.pages[-1].obj.Contents = pdf.make_stream(content)
+    buffer = io.BytesIO()
+    pdf.save(buffer, compress_streams=False, object_stream_mode=pikepdf.ObjectStreamMode.disable)
+    original = app_module.storage.put(io.BytesIO(buffer.getvalue()), 'pdf')
+    book_id = add_book('Bloated', filename=original)
+
+    result = app_module.optimize_book_pdf(book_id)
+    assert result['status'] == 'optimized', result['error']
+    assert result['optimized_size'] < result['original_size']
+    assert book_files(app_module) == [result['optimized_key']]
+    assert not app_module.storage.exists(original)
+    with pikepdf.open(app_module.storage.path(result['optimized_key'])) as optimized:
+        assert len(optimized.pages) == 5
+        assert optimized.is_linearized
@@ -0,0 +1,61 @@
+import tracemalloc
+
+import pytest
+
+
+@pytest.fixture
+def profiles(app_module, tmp_path, monkeypatch):
+    folder = tmp_path / 'profiles'
+    monkeypatch.setattr(app_module, 'PROFILE_FOLDER', str(folder))
+    monkeypatch.setattr(app_module, 'PROFILE_TOKEN', 'secret')
+    yield folder
+    app_module.set_runtime_setting('profile_sample_rate', 0)
+    app_module._profile_settings['loaded_at'] = 0.0
+
+
+def test_admin_toggle_profiles_requests(app_module, admin_client, profiles):
+    response = admin_client.post('/admin/profiling', data={'sample_rate': '1', 'mode': 'cprofile'})
+    assert response.status_code == 302
+    app_module._profile_settings['loaded_at'] = 0.0
+
+    name = admin_client.get('/').headers['X-Profile-Id']
+    assert '_index_cprofile_' in name and name.endswith('.prof')
+    assert (profiles / name).exists()
+    assert name in admin_client.get('/admin/profiling').get_data(as_text=True)
+
+    admin_client.post('/admin/profiling', data={'sample_rate': '0', 'mode': 'cprofile'})
+    app_module._profile_settings['loaded_at'] = 0.0
+    assert 'X-Profile-Id' not in admin_client.get('/').headers
+
+
+def test_only_one_request_is_profiled_at_a_time(app_module, client, profiles):
+    headers = {'X-Profile': 'sample', 'X-Profile-Token': 'secret'}
+    running = app_module.RequestProfiler('cprofile', 'other')
+    assert running.start()
+    try:
+        assert not app_module.RequestProfiler('cprofile', 'third').start()
+        assert 'X-Profile-Id' not in client.get('/', headers=headers).headers
+    finally:
+        running.stop()
+    name = client.get('/', headers=headers).headers['X-Profile-Id']
+    assert name.endswith('.collapsed')
+    assert (profiles / name).exists()
+
+
+def test_memory_profile_leaves_existing_tracing_running(app_module, client, profiles):
+    headers = {'X-Profile': 'memory', 'X-Profile-Token': 'secret'}
+    assert not tracemalloc.is_tracing()
+    assert client.get('/', headers=headers).headers['X-Profile-Id'].endswith('.txt')
+    assert not tracemalloc.is_tracing()
+
+    tracemalloc.start()
+    try:
+        client.get('/', headers=headers)
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_profile_header_needs_the_token(client, profiles):
+    assert 'X-Profile-Id' not in client.get('/', headers={'X-Profile': 'sample', 'X-Profile-Token': 'wrong'}).headers
+    assert not profiles.exists()
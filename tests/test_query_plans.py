@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+# Pages that list the whole catalog, and substring search, read every book by design
+CATALOG_LISTING = 'SELECT * FROM books ORDER BY upload_date DESC'
+SORTED_LISTINGS = [f'SELECT * FROM books ORDER BY {column}' for column in (
+    'title_sort_ar, id', 'title_sort_en, id', 'author_sort_ar, title_sort_ar, id', 'author_sort_en, title_sort_en, id',
+)]
+SUBSTRING_SEARCH = 'SELECT * FROM books WHERE title LIKE ? OR author LIKE ? ORDER BY '
+
+
+@pytest.fixture
+def book_id(app_module):
+    conn = app_module.get_db_connection()
+    book_id = conn.execute('SELECT id FROM books LIMIT 1').fetchone()['id']
+    conn.close()
+    return book_id
+
+
+def test_index(app_module, admin_client):
+    app_module.refresh_book_rankings()
+    with app_module.assert_no_full_scans(allowed=[CATALOG_LISTING]) as plans:
+        assert admin_client.get('/').status_code == 200
+    assert any(fingerprint.endswith('LIMIT ?') for fingerprint, _ in plans)
+
+
+@pytest.mark.parametrize('sort', ['newest', 'title', 'author'])
+def test_books(app_module, admin_client, sort):
+    with app_module.assert_no_full_scans(allowed=[CATALOG_LISTING] + SORTED_LISTINGS):
+        assert admin_client.get(f'/books?sort={sort}').status_code == 200
+
+
+@pytest.mark.parametrize('sort', ['newest', 'title'])
+def test_search(app_module, admin_client, sort):
+    allowed = [SUBSTRING_SEARCH + order for order in (
+        'upload_date DESC', 'title_sort_ar, id', 'title_sort_en, id',
+    )]
+    with app_module.assert_no_full_scans(allowed=allowed) as plans:
+        assert admin_client.get(f'/search?q=a&sort={sort}').status_code == 200
+    assert plans
+
+
+def test_book_detail(app_module, admin_client, book_id):
+    with app_module.assert_no_full_scans():
+        assert admin_client.get(f'/book/{book_id}').status_code == 200
+
+
+def test_suggest(app_module, admin_client):
+    index = app_module.suggest_index
+    index.refresh()
+    deadline = time.monotonic() + 5
+    while not index._loaded and time.monotonic() < deadline:
+        time.sleep(0.01)
+    index._checked_at = 0.0  # make this request read the change log
+    with app_module.assert_no_full_scans() as plans:
+        assert admin_client.get('/suggest?q=a').status_code == 200
+    assert any('book_changes' in fingerprint for fingerprint, _ in plans)
+
+
+def test_limit_bounded_scan_is_exempt_but_filtered_scan_is_not(app_module):
+    conn = app_module.get_db_connection()
+    try:
+        with app_module.assert_no_full_scans() as plans:
+            conn.execute('SELECT * FROM books ORDER BY upload_date DESC LIMIT 6').fetchall()
+        assert plans[0][1][0].endswith(app_module.BOUNDED_SCAN_NOTE)
+        with pytest.raises(AssertionError, match='Full table scans'):
+            with app_module.assert_no_full_scans():
+                conn.execute(
+                    'SELECT * FROM books WHERE title LIKE ? ORDER BY upload_date DESC LIMIT 6', ('%a%',)
+                ).fetchall()
+        with pytest.raises(AssertionError, match='Full table scans'):
+            with app_module.assert_no_full_scans():
+                conn.execute('SELECT category, COUNT(*) FROM books GROUP BY category LIMIT 5').fetchall()
+    finally:
+        conn.close()
@@ -0,0 +1,76 @@
+import pytest
+
+
+@pytest.fixture
+def book_id(app_module):
+    conn = app_module.get_db_connection()
+    book_id = conn.execute('SELECT id FROM books LIMIT 1').fetchone()['id']
+    conn.close()
+    return book_id
+
+
+@pytest.mark.parametrize('body', [
+    [1, 2], 'page', 7, None,
+    {'page': 'three'}, {'page': True}, {'page': 0}, {'page': [3]}, {'page': 10 ** 30},
+    {'page': 3, 'position': 'half'}, {'page': 3, 'position': {'x': 1}},
+])
+def test_progress_rejects_malformed_bodies(admin_client, book_id, body):
+    response = admin_client.post(f'/api/progress/{book_id}', json=body)
+    assert response.status_code == 400
+
+
+def test_progress_accepts_page_and_clamps_position(admin_client, book_id):
+    response = admin_client.post(f'/api/progress/{book_id}', json={'page': 4, 'position': 1.7, 'updated_at': 1e400})
+    assert response.status_code == 202
+    assert response.get_json()['page'] == 4
+
+
+@pytest.mark.parametrize('body', [
+    ['note'], 'page', 3,
+    {'page': 'x'}, {'page': False}, {'page': 2, 'note': 42}, {'page': 2, 'note': ['a']},
+    {'page': 2, 'id': 'not a valid id!'},
+])
+def test_bookmarks_reject_malformed_bodies(admin_client, book_id, body):
+    response = admin_client.post(f'/api/bookmarks/{book_id}', json=body)
+    assert response.status_code == 400
+
+
+def test_bookmark_round_trip(admin_client, book_id):
+    response = admin_client.post(f'/api/bookmarks/{book_id}', json={'page': '12', 'note': 'n' * 600, 'updated_at': 1000})
+    assert response.status_code == 200
+    saved = [b for b in response.get_json()['bookmarks'] if b['page'] == 12]
+    assert len(saved) == 1 and len(saved[0]['note']) == 500
+
+    assert admin_client.delete(f"/api/bookmarks/{book_id}/{saved[0]['id']}", json=[1]).status_code == 400
+    assert admin_client.delete(f"/api/bookmarks/{book_id}/{saved[0]['id']}").status_code == 204
+    remaining = admin_client.get(f'/api/bookmarks/{book_id}').get_json()['bookmarks']
+    assert saved[0]['id'] not in [b['id'] for b in remaining]
+
+
+def test_bookmark_id_cannot_move_to_another_book(app_module, admin_client, book_id):
+    conn = app_module.get_db_connection()
+    other_id = conn.execute(
+        "INSERT INTO books (title, author, filename) VALUES ('Other', 'Someone', 'other.pdf')"
+    ).lastrowid
+    conn.commit()
+    conn.close()
+    bookmark = {'id': 'bookmark-move-1', 'page': 5, 'updated_at': 1000}
+    admin_client.post(f'/api/bookmarks/{book_id}', json=bookmark)
+    admin_client.post(f'/api/bookmarks/{other_id}', json=dict(bookmark, page=9, updated_at=2000))
+
+    ids = [b['id'] for b in admin_client.get(f'/api/bookmarks/{book_id}').get_json()['bookmarks']]
+    assert 'bookmark-move-1' in ids
+    assert admin_client.get(f'/api/bookmarks/{other_id}').get_json()['bookmarks'] == []
+
+
+def test_delete_before_create_leaves_tombstone(admin_client, book_id):
+    bookmark_id = 'bookmark-late-create'
+    assert admin_client.delete(f'/api/bookmarks/{book_id}/{bookmark_id}', json={'updated_at': 2000}).status_code == 204
+    admin_client.post(f'/api/bookmarks/{book_id}', json={'id': bookmark_id, 'page': 3, 'updated_at': 1000})
+    ids = [b['id'] for b in admin_client.get(f'/api/bookmarks/{book_id}').get_json()['bookmarks']]
+    assert bookmark_id not in ids
+
+    # A newer edit still wins over the tombstone
+    admin_client.post(f'/api/bookmarks/{book_id}', json={'id': bookmark_id, 'page': 3, 'updated_at': 3000})
+    ids = [b['id'] for b in admin_client.get(f'/api/bookmarks/{book_id}').get_json()['bookmarks']]
+    assert bookmark_id in ids
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def cookie_name(app_module):
+    return app_module.app.config['SESSION_COOKIE_NAME']
+
+
+def stored_session(app_module, sid):
+    row = app_module.get_runtime_connection().execute('SELECT data FROM sessions WHERE sid = ?', (sid,)).fetchone()
+    return row and app_module.SQLiteSessionInterface.serializer.loads(row[0])
+
+
+def login(app_module, client):
+    return client.post('/login', data={
+        'first_name': 'Test', 'last_name': 'Reader', 'email': app_module.ALLOWED_ADD_BOOK_EMAIL,
+    })
+
+
+def test_cookie_holds_only_an_opaque_id(app_module, client, cookie_name):
+    response = login(app_module, client)
+    set_cookie = [value for value in response.headers.getlist('Set-Cookie') if value.startswith(f'{cookie_name}=')]
+    assert len(set_cookie) == 1
+    sid = client.get_cookie(cookie_name).value
+    assert app_module.SESSION_ID_RE.match(sid)
+    assert app_module.ALLOWED_ADD_BOOK_EMAIL not in set_cookie[0]
+    assert stored_session(app_module, sid)['email'] == app_module.ALLOWED_ADD_BOOK_EMAIL
+
+    # The same data as a signed cookie grows with the session; the id never does
+    signed = app_module.SQLiteSessionInterface.legacy_interface.get_signing_serializer(app_module.app).dumps(
+        stored_session(app_module, sid))
+    assert len(set_cookie[0]) < 200 < len(signed)
+
+
+def test_login_rotates_the_session_id(app_module, client, cookie_name):
+    client.get('/set_language/en')
+    before = client.get_cookie(cookie_name).value
+    assert stored_session(app_module, before) == {'language': 'en'}
+
+    login(app_module, client)
+    after = client.get_cookie(cookie_name).value
+    assert after != before
+    assert stored_session(app_module, before) is None
+    assert stored_session(app_module, after)['language'] == 'en'
+
+
+def test_signed_cookie_session_is_migrated_once(app_module, client, cookie_name):
+    legacy = {'email': 'legacy@example.com', 'first_name': 'Old', 'last_name': 'Cookie',
+              'logged_in': True, 'language': 'ar'}
+    signer = app_module.SQLiteSessionInterface.legacy_interface.get_signing_serializer(app_module.app)
+    client.set_cookie(cookie_name, signer.dumps(legacy))
+
+    first = client.get('/set_language/en')
+    sid = client.get_cookie(cookie_name).value
+    assert app_module.SESSION_ID_RE.match(sid)
+    assert stored_session(app_module, sid) == dict(legacy, language='en')
+    assert any(value.startswith(f'{cookie_name}={sid}') for value in first.headers.getlist('Set-Cookie'))
+
+    conn = app_module.get_runtime_connection()
+    count = conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+    second = client.get('/set_language/ar')
+    assert client.get_cookie(cookie_name).value == sid
+    assert not [value for value in second.headers.getlist('Set-Cookie') if value.startswith(f'{cookie_name}=')]
+    assert conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0] == count
+    assert stored_session(app_module, sid)['email'] == 'legacy@example.com'
+
+
+def test_expired_sessions_are_ignored_and_swept(app_module, client, cookie_name, monkeypatch):
+    login(app_module, client)
+    sid = client.get_cookie(cookie_name).value
+    conn = app_module.get_runtime_connection()
+    conn.execute('UPDATE sessions SET expires_at = 0 WHERE sid = ?', (sid,))
+    conn.execute('INSERT INTO sessions (sid, data, expires_at) VALUES (?, ?, 0)',
+                 ('x' * 43, json.dumps({'email': 'gone@example.com'})))
+
+    # An expired id reads as a fresh, logged-out session
+    assert client.get('/add_book').status_code == 302
+
+    monkeypatch.setattr(app_module.app.session_interface, '_swept_at', 0.0)
+    client.get('/set_language/ar')
+    assert conn.execute('SELECT COUNT(*) FROM sessions WHERE expires_at = 0').fetchone()[0] == 0
+    assert client.get_cookie(cookie_name).value != sid
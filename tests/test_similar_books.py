@@ -0,0 +1,84 @@
+import pytest
+
+
+@pytest.fixture(params=['python', 'numpy'])
+def vector_backend(request, app_module, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+        monkeypatch.setattr(app_module, 'NUMPY_AVAILABLE', True)
+    else:
+        monkeypatch.setattr(app_module, 'NUMPY_AVAILABLE', False)
+    return request.param
+
+
+@pytest.fixture
+def catalog(empty_library, add_book):
+    return {
+        'andalus': add_book('تاريخ الأندلس', 'محمد عبد الله عنان', category='History', language='ar',
+                            description='سقوط الأندلس وممالك الطوائف وقرطبة وغرناطة'),
+        'andalus2': add_book('الأندلس من الفتح إلى السقوط', 'محمد عبد الله عنان', category='History', language='ar',
+                             description='قرطبة وغرناطة وممالك الطوائف في الأندلس'),
+        'cordoba': add_book('Cordoba and Granada', 'Maria Menocal', category='History', language='en',
+                            description='the caliphate of cordoba and the fall of granada'),
+        'chemistry': add_book('Organic Chemistry', 'Paula Bruice', category='Science', language='en',
+                              description='reactions of alkenes and aromatic compounds'),
+    }
+
+
+def similar_ids(app_module, book_id):
+    conn = app_module.get_db_connection()
+    rows = app_module.get_similar_books(conn, book_id)
+    conn.close()
+    return [row['id'] for row in rows]
+
+
+def test_rebuild_ranks_closest_book_first(app_module, vector_backend, catalog):
+    assert app_module.rebuild_similar_books() == len(catalog)
+    ranked = similar_ids(app_module, catalog['andalus'])
+    assert ranked[0] == catalog['andalus2']
+    assert catalog['chemistry'] not in ranked
+    assert catalog['andalus'] not in ranked
+
+
+def test_top_k_is_limited(app_module, vector_backend, empty_library, add_book, monkeypatch):
+    monkeypatch.setattr(app_module, 'SIMILAR_BOOKS_LIMIT', 2)
+    ids = [add_book(f'Poems of the desert night {i}', 'Same Poet', category='Poetry') for i in range(5)]
+    app_module.rebuild_similar_books()
+    vectors = app_module.VectorSet.load(app_module.get_db_connection())
+    top = vectors.top_similar(ids, k=2)
+    assert all(len(pairs) == 2 for pairs in top.values())
+    assert all(score >= scores[-1][1] for scores in top.values() for _, score in scores)
+
+
+def test_incremental_add_and_remove(app_module, vector_backend, catalog, add_book):
+    app_module.rebuild_similar_books()
+    new_id = add_book('غرناطة آخر ممالك الأندلس', 'محمد عبد الله عنان', category='History', language='ar',
+                      description='سقوط غرناطة وقرطبة والأندلس')
+    app_module.add_book_similarity(new_id)
+    assert catalog['andalus'] in similar_ids(app_module, new_id)
+    assert new_id in similar_ids(app_module, catalog['andalus'])
+
+    conn = app_module.get_db_connection()
+    book = conn.execute('SELECT * FROM books WHERE id = ?', (new_id,)).fetchone()
+    conn.execute('DELETE FROM books WHERE id = ?', (new_id,))
+    conn.commit()
+    conn.close()
+    app_module.remove_book_similarity(new_id, list(app_module.book_terms(book)))
+    assert new_id not in similar_ids(app_module, catalog['andalus'])
+    assert similar_ids(app_module, catalog['andalus'])[0] == catalog['andalus2']
+
+
+def test_add_rebuilds_when_vectors_are_missing(app_module, vector_backend, catalog):
+    app_module.add_book_similarity(catalog['andalus2'])
+    conn = app_module.get_db_connection()
+    assert conn.execute('SELECT COUNT(*) FROM book_vectors').fetchone()[0] == len(catalog)
+    conn.close()
+
+
+def test_article_is_stripped_the_same_way_everywhere(app_module):
+    assert app_module.strip_arabic_article('الكتب') == 'كتب'
+    assert app_module.strip_arabic_article('الي') == 'الي'
+    terms = app_module.book_terms({'title': 'الكتب', 'author': '', 'category': None, 'language': None,
+                                   'publication_year': None, 'description': ''})
+    assert 'w:كتب' in terms
+    assert app_module.sort_key('الكتب', 'ar') == app_module.sort_key('كتب', 'ar')
@@ -0,0 +1,63 @@
+import pytest
+
+TITLES = ['Vol 10', 'الكتاب 10', 'The Castle', 'بين القصرين', 'Zorba', 'الأيام', '1984', 'Vol 2',
+          'أولاد حارتنا', 'A Book of Sand', 'إحياء علوم الدين', 'الكتاب 2', 'ابن سينا']
+
+EXPECTED = {
+    # Digits first, then the interface language's script, then the other one. Articles
+    # ("The", "A", "ال") are ignored, hamza forms fold into alif and numbers compare by value.
+    'en': ['1984', 'A Book of Sand', 'The Castle', 'Vol 2', 'Vol 10', 'Zorba',
+           'ابن سينا', 'إحياء علوم الدين', 'أولاد حارتنا', 'الأيام', 'بين القصرين', 'الكتاب 2', 'الكتاب 10'],
+    'ar': ['1984', 'ابن سينا', 'إحياء علوم الدين', 'أولاد حارتنا', 'الأيام', 'بين القصرين', 'الكتاب 2', 'الكتاب 10',
+           'A Book of Sand', 'The Castle', 'Vol 2', 'Vol 10', 'Zorba'],
+}
+
+
+@pytest.mark.parametrize('language', ['en', 'ar'])
+def test_sort_key_order(app_module, language):
+    assert sorted(TITLES, key=lambda title: app_module.sort_key(title, language)) == EXPECTED[language]
+
+
+@pytest.mark.parametrize('text, same_as', [
+    ('The Castle', 'Castle'),
+    ('الكتاب', 'كتاب'),
+    ('Éducation', 'education'),
+    ('مُقَدِّمَة', 'مقدمة'),
+    ('Part 007', 'Part 7'),
+])
+def test_sort_key_folds(app_module, text, same_as):
+    for language in ('en', 'ar'):
+        assert app_module.sort_key(text, language) == app_module.sort_key(same_as, language)
+
+
+def test_lone_article_is_kept(app_module):
+    assert app_module.sort_key('A', 'en') != app_module.sort_key('', 'en')
+
+
+@pytest.mark.parametrize('language', ['en', 'ar'])
+def test_books_page_uses_sort_keys(app_module, admin_client, empty_library, add_book, language):
+    for title in TITLES:
+        add_book(title, 'Someone', filename=f'{len(title)}-{title}.pdf')
+    admin_client.get(f'/set_language/{language}')
+    page = admin_client.get('/books?sort=title').get_data(as_text=True)
+    positions = [page.index(title) for title in EXPECTED[language]]
+    assert positions == sorted(positions)
+
+
+def test_init_database_backfills_existing_rows(app_module, empty_library):
+    conn = app_module.get_db_connection()
+    conn.executemany(
+        'INSERT INTO books (title, author, filename) VALUES (?, ?, ?)',
+        [('Vol 10', 'The Author', 'a.pdf'), ('الأيام', 'طه حسين', 'b.pdf')]
+    )
+    conn.commit()
+    assert conn.execute('SELECT COUNT(*) FROM books WHERE title_sort_en IS NULL').fetchone()[0] == 2
+    conn.close()
+
+    app_module.init_database()
+
+    conn = app_module.get_db_connection()
+    columns = app_module.sort_key_columns()
+    for row in conn.execute(f'SELECT title, author, {", ".join(columns)} FROM books'):
+        assert {column: row[column] for column in columns} == app_module.book_sort_keys(row['title'], row['author'])
+    conn.close()
@@ -0,0 +1,108 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+
+PDF = b'%PDF-1.4 storage test\n'
+SHA = hashlib.sha256(PDF).hexdigest()
+
+
+def test_local_storage_shards_keys_and_stores_identical_content_once(app_module, tmp_path):
+    storage = app_module.LocalStorage(str(tmp_path / 'uploads'))
+    key = storage.put(io.BytesIO(PDF), 'pdf')
+    assert key == f'{SHA[:2]}/{SHA[2:4]}/{SHA}.pdf'
+    assert storage.path(key) == str(tmp_path / 'uploads' / SHA[:2] / SHA[2:4] / f'{SHA}.pdf')
+
+    assert storage.put(io.BytesIO(PDF), 'pdf') == key
+    assert list(storage.iter_keys(SHA[:2])) == [key]
+    assert os.listdir(storage.spool_dir) == []
+    with storage.open(key) as stream:
+        assert stream.read() == PDF
+
+    assert storage.delete(key)
+    assert not storage.exists(key)
+    assert not storage.delete(key)
+
+
+def test_local_storage_finds_legacy_flat_files(app_module, tmp_path):
+    covers = tmp_path / 'covers'
+    covers.mkdir()
+    (covers / 'old_cover.jpg').write_bytes(b'jpeg')
+    storage = app_module.LocalStorage(str(tmp_path / 'uploads'), legacy_dirs=[str(covers)])
+    assert storage.exists('old_cover.jpg')
+    assert storage.path('old_cover.jpg') == str(covers / 'old_cover.jpg')
+    assert not storage.exists('missing.jpg')
+
+
+def test_shared_blob_is_deleted_only_with_its_last_book(app_module, empty_library, add_book):
+    key = app_module.storage.put(io.BytesIO(PDF), 'pdf')
+    first = add_book('Palace Walk', filename=key)
+    second = add_book('Palace Walk (copy)', filename=key)
+
+    conn = app_module.get_db_connection()
+    conn.execute('DELETE FROM books WHERE id = ?', (first,))
+    conn.commit()
+    assert not app_module.delete_blob_if_unreferenced(key, conn)
+    assert app_module.storage.exists(key)
+
+    conn.execute('DELETE FROM books WHERE id = ?', (second,))
+    conn.commit()
+    assert app_module.delete_blob_if_unreferenced(key, conn)
+    assert not app_module.storage.exists(key)
+    conn.close()
+
+
+def test_storage_sweep_reports_and_deletes_orphans(app_module, empty_library, add_book):
+    kept = app_module.storage.put(io.BytesIO(PDF), 'pdf')
+    orphan = app_module.storage.put(io.BytesIO(b'%PDF-1.4 orphan\n'), 'pdf')
+    missing = f'ab/cd/abcd{"0" * 60}.pdf'
+    add_book('Kept', filename=kept)
+    add_book('Lost', filename=missing)
+    runner = app_module.app.test_cli_runner()
+
+    result = runner.invoke(app_module.storage_sweep)
+    assert result.exit_code == 0, result.output
+    assert f'missing {missing}' in result.output
+    assert f'orphan {orphan}' in result.output
+    assert app_module.storage.exists(orphan)
+
+    result = runner.invoke(app_module.storage_sweep, ['--delete'])
+    assert result.exit_code == 0, result.output
+    assert 'Orphaned blobs: 1 (deleted)' in result.output
+    assert not app_module.storage.exists(orphan)
+    assert app_module.storage.exists(kept)
+
+
+def test_s3_storage_against_moto_server(app_module, monkeypatch):
+    pytest.importorskip('boto3')
+    moto_server = pytest.importorskip('moto.server')
+    for name, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')):
+        monkeypatch.setenv(name, value)
+    server = moto_server.ThreadedMotoServer(port=0)
+    server.start()
+    try:
+        host, port = server.get_host_and_port()
+        endpoint = f'http://{host}:{port}'
+        app_module.boto3.client('s3', endpoint_url=endpoint).create_bucket(Bucket='library')
+        storage = app_module.S3Storage('library', endpoint_url=endpoint)
+
+        key = storage.put(io.BytesIO(PDF), 'pdf')
+        assert key == f'{SHA[:2]}/{SHA[2:4]}/{SHA}.pdf'
+        assert storage.put(io.BytesIO(PDF), 'pdf') == key
+        assert storage.exists(key)
+        assert storage.size(key) == len(PDF)
+        assert storage.open(key).read() == PDF
+        assert list(storage.iter_keys(SHA[:2])) == [key]
+
+        with app_module.app.test_request_context():
+            response = storage.send(key, download_name='book.pdf', as_attachment=True)
+        assert response.status_code == 302
+        assert response.location.startswith(f'{endpoint}/library/{key}?')
+
+        assert storage.delete(key)
+        assert not storage.exists(key)
+    finally:
+        server.stop()
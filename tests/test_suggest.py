@@ -0,0 +1,81 @@
+import random
+import time
+
+import pytest
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+def test_suggest_finds_books_by_title_and_author(app_module, client):
+    conn = app_module.get_db_connection()
+    book = conn.execute('SELECT id, title, author FROM books LIMIT 1').fetchone()
+    conn.close()
+    client.get('/suggest?q=x')
+    wait_until(lambda: app_module.suggest_index._loaded)
+    for query in (book['title'][:2], book['author'][:2]):
+        ids = [s['id'] for s in client.get('/suggest', query_string={'q': query}).get_json()['suggestions']]
+        assert book['id'] in ids
+
+
+def test_failed_background_build_is_retried(app_module, monkeypatch):
+    index = app_module.SuggestIndex()
+    monkeypatch.setattr(index, 'load', lambda: 1 / 0)
+    index.refresh()
+    wait_until(lambda: not index._loading)
+    assert not index._loaded
+
+    monkeypatch.undo()
+    index.refresh()
+    wait_until(lambda: index._loaded)
+    assert not index._loading
+
+
+WORDS = ('history', 'science', 'garden', 'river', 'desert', 'night', 'poems', 'letters', 'city', 'journey',
+         'تاريخ', 'الأندلس', 'مدينة', 'رحلة', 'الشعر', 'العلوم', 'ليلة', 'الصحراء', 'رسائل', 'النهر')
+AUTHORS = ('Naguib Mahfouz', 'Ibn Khaldun', 'Jane Austen', 'طه حسين', 'نجيب محفوظ', 'Leo Tolstoy')
+
+
+@pytest.mark.parametrize('books', [100_000])
+def test_lookup_p99_and_memory_at_scale(app_module, books):
+    rng = random.Random(29)
+    rows = [
+        (book_id, ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))) + f' {book_id}',
+         rng.choice(AUTHORS))
+        for book_id in range(1, books + 1)
+    ]
+    index = app_module.SuggestIndex()
+    index.build(rows, marker=0)
+    queries = [word[:length] for word in WORDS + AUTHORS for length in (1, 2, 3, 5, 8)]
+    for _ in range(2000):
+        index.lookup(rng.choice(queries))
+    stats = index.stats()
+    assert stats['books'] == books
+    assert stats['lookup_p99_ms'] < 5
+    assert stats['memory_bytes'] < 300 * books  # about 250 bytes per title measured, text stored twice
+
+
+def test_refresh_applies_changes_from_other_workers(app_module, empty_library, add_book, monkeypatch):
+    kept = add_book('Palace Walk', 'Naguib Mahfouz', filename='a.pdf')
+    renamed = add_book('Sugar Street', 'Naguib Mahfouz', filename='b.pdf')
+    index = app_module.SuggestIndex()
+    index.load()
+
+    conn = app_module.get_db_connection()
+    conn.execute("UPDATE books SET title = 'Palace of Desire' WHERE id = ?", (renamed,))
+    conn.execute('DELETE FROM books WHERE id = ?', (kept,))
+    conn.commit()
+    conn.close()
+    added = add_book('الأيام', 'طه حسين', filename='c.pdf')
+
+    monkeypatch.setattr(app_module, 'SUGGEST_REFRESH_SECONDS', 0)
+    index.refresh()
+    assert [book_id for book_id, _, _ in index.lookup('palace')] == [renamed]
+    assert index.lookup('sugar') == []
+    assert [book_id for book_id, _, _ in index.lookup('ايام')] == [added]
+    assert index.stats()['books'] == 2
@@ -0,0 +1,45 @@
+import xml.etree.ElementTree as ET
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+
+
+def test_changes_backfills_existing_books(app_module, admin_client):
+    response = admin_client.get('/changes?since=0')
+    assert response.status_code == 200
+    data = response.get_json()
+    conn = app_module.get_db_connection()
+    book_ids = {row['id'] for row in conn.execute('SELECT id FROM books')}
+    conn.close()
+    assert {change['book_id'] for change in data['changes'] if change['op'] == 'upsert'} >= book_ids
+
+    caught_up = admin_client.get(f"/changes?since={data['next_since']}").get_json()
+    assert caught_up['changes'] == []
+    assert caught_up['next_since'] == data['next_since']
+    assert caught_up['has_more'] is False
+
+
+def test_changes_reports_deletes(app_module, admin_client):
+    conn = app_module.get_db_connection()
+    cursor = conn.execute(
+        "INSERT INTO books (title, author, filename) VALUES ('Temporary', 'Nobody', 'temporary.pdf')"
+    )
+    book_id = cursor.lastrowid
+    conn.commit()
+    since = app_module.latest_change_seq(conn)
+    conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
+    conn.commit()
+    conn.close()
+
+    changes = admin_client.get(f'/changes?since={since}').get_json()['changes']
+    assert changes == [{'seq': since + 1, 'op': 'delete', 'book_id': book_id}]
+
+
+def test_opds_feed_lists_catalog(app_module, admin_client):
+    response = admin_client.get('/opds')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/atom+xml'
+    feed = ET.fromstring(response.get_data())
+    conn = app_module.get_db_connection()
+    count = conn.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+    conn.close()
+    assert len(feed.findall(f'{ATOM}entry')) == count
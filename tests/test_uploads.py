@@ -0,0 +1,135 @@
+import base64
+import hashlib
+import os
+
+import pytest
+
+
+CHUNK = 16
+PDF = b'%PDF-1.4 resumable upload test body\n'  # three chunks: 16 + 16 + 4 bytes
+
+
+@pytest.fixture
+def uploads(app_module, empty_library, monkeypatch):
+    monkeypatch.setattr(app_module, 'RESUMABLE_CHUNK_SIZE', CHUNK)
+    monkeypatch.setattr(app_module, 'RESUMABLE_FOLDER', str(empty_library / 'uploads' / '.resumable'))
+    return empty_library
+
+
+def start(client, size=len(PDF)):
+    response = client.post('/api/uploads', json={'size': size, 'filename': 'book.pdf'})
+    assert response.status_code == 201, response.get_json()
+    return response.get_json()['location']
+
+
+def send(client, location, chunk, data=PDF, checksum=None):
+    body = data[chunk * CHUNK:(chunk + 1) * CHUNK]
+    checksum = checksum or base64.b64encode(hashlib.sha256(body).digest()).decode()
+    return client.patch(location, data=body, headers={
+        'Content-Type': 'application/offset+octet-stream',
+        'Upload-Offset': str(chunk * CHUNK),
+        'Upload-Checksum': f'sha256 {checksum}',
+    })
+
+
+def tree_checksum(data):
+    digests = b''.join(hashlib.sha256(data[i:i + CHUNK]).digest() for i in range(0, len(data), CHUNK))
+    return hashlib.sha256(digests).hexdigest()
+
+
+def submit(app_module, client, location, checksum=None):
+    client.post('/add_book', data={
+        'title': 'Resumed', 'author': 'Tester', 'description': '',
+        'upload_id': location.rsplit('/', 1)[1], 'upload_checksum': checksum or tree_checksum(PDF),
+    })
+    conn = app_module.get_db_connection()
+    row = conn.execute("SELECT filename FROM books WHERE title = 'Resumed'").fetchone()
+    conn.close()
+    return row['filename'] if row else None
+
+
+def test_upload_api_answers_401_when_logged_out(client):
+    response = client.patch('/api/uploads/abc', data=b'x', headers={
+        'Content-Type': 'application/offset+octet-stream', 'Upload-Offset': '0'
+    })
+    assert response.status_code == 401
+    assert client.head('/api/uploads/abc').status_code == 401
+
+
+def test_oversize_upload_is_rejected(app_module, admin_client, uploads, monkeypatch):
+    monkeypatch.setattr(app_module, 'MAX_RESUMABLE_FILE_SIZE', 1024)
+    assert admin_client.post('/api/uploads', json={'size': 1025, 'filename': 'book.pdf'}).status_code == 413
+    assert admin_client.post('/api/uploads', json={'size': 1024, 'filename': 'book.pdf'}).status_code == 201
+
+
+def test_chunks_at_the_wrong_offset_or_length_are_rejected(admin_client, uploads):
+    location = start(admin_client)
+    headers = {'Content-Type': 'application/offset+octet-stream'}
+    for offset in ('5', str(len(PDF) + CHUNK), 'x'):
+        response = admin_client.patch(location, data=PDF[:CHUNK], headers={**headers, 'Upload-Offset': offset})
+        assert response.status_code == 409
+    response = admin_client.patch(location, data=PDF[:CHUNK - 1], headers={**headers, 'Upload-Offset': '0'})
+    assert response.status_code == 400
+    assert admin_client.head(location).headers['Upload-Received'] == ''
+
+
+def test_chunk_with_a_bad_checksum_is_not_recorded(admin_client, uploads):
+    location = start(admin_client)
+    wrong = base64.b64encode(hashlib.sha256(b'other').digest()).decode()
+    assert send(admin_client, location, 0, checksum=wrong).status_code == 460
+    assert admin_client.head(location).headers['Upload-Received'] == ''
+
+
+def test_partial_upload_resumes_and_duplicate_chunks_are_harmless(app_module, admin_client, uploads):
+    location = start(admin_client)
+    assert send(admin_client, location, 0).status_code == 204
+    response = send(admin_client, location, 2)
+    assert response.headers['Upload-Offset'] == str(CHUNK)
+    assert response.headers['Upload-Received'] == '0,2'
+
+    # A client that lost its state asks where it stopped, resends a chunk twice, then finishes
+    head = admin_client.head(location)
+    assert (head.headers['Upload-Offset'], head.headers['Upload-Length']) == (str(CHUNK), str(len(PDF)))
+    assert send(admin_client, location, 0).headers['Upload-Received'] == '0,2'
+    response = send(admin_client, location, 1)
+    assert response.headers['Upload-Offset'] == str(len(PDF))
+    assert response.headers['Upload-Received'] == '0-2'
+
+    key = submit(app_module, admin_client, location)
+    with app_module.storage.open(key) as stream:
+        assert stream.read() == PDF
+    assert admin_client.head(location).status_code == 404
+
+
+def test_failed_final_checksum_drops_only_the_bad_chunk(app_module, admin_client, uploads):
+    location = start(admin_client)
+    for chunk in range(3):
+        send(admin_client, location, chunk)
+    upload_id = location.rsplit('/', 1)[1]
+    with open(app_module.resumable_path(upload_id), 'r+b') as handle:
+        handle.seek(CHUNK + 3)
+        handle.write(b'!')
+
+    assert submit(app_module, admin_client, location) is None
+    head = admin_client.head(location)
+    assert head.status_code == 200
+    assert head.headers['Upload-Received'] == '0,2'
+
+    send(admin_client, location, 1)
+    key = submit(app_module, admin_client, location)
+    with app_module.storage.open(key) as stream:
+        assert stream.read() == PDF
+
+
+def test_expired_upload_is_gone_and_swept(app_module, admin_client, uploads):
+    location = start(admin_client)
+    send(admin_client, location, 0)
+    upload_id = location.rsplit('/', 1)[1]
+    conn = app_module.get_runtime_connection()
+    conn.execute('UPDATE resumable_uploads SET expires_at = 0 WHERE id = ?', (upload_id,))
+
+    assert admin_client.head(location).status_code == 404
+    assert send(admin_client, location, 1).status_code == 404
+    start(admin_client)
+    assert not os.path.exists(app_module.resumable_path(upload_id))
+    assert conn.execute('SELECT COUNT(*) FROM resumable_chunks WHERE upload_id = ?', (upload_id,)).fetchone()[0] == 0